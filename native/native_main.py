@@ -1,26 +1,139 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import contextlib
+import errno
+import getpass
 import json
+import mmap
 import os
 import pathlib
+import queue
 import re
 import shutil
+import socket
+import stat
 import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 DEBUG = False
 VERSION = "0.1.11"
 
+# Files created by the 'temp' command are garbage collected once they are
+# older than TEMP_MAX_AGE seconds, or once the scratch directory holds more
+# than TEMP_MAX_BYTES (oldest files go first).
+TEMP_MAX_AGE = int(os.environ.get("TRIDACTYL_TEMP_MAX_AGE") or 24 * 60 * 60)
+TEMP_MAX_BYTES = int(
+    os.environ.get("TRIDACTYL_TEMP_MAX_BYTES") or 64 * 1024 * 1024
+)
+
+# 'copy' and 'move' transfer files in chunks of COPY_CHUNK_SIZE bytes and
+# send at most one progress frame every PROGRESS_INTERVAL seconds.
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+PROGRESS_INTERVAL = 0.25
+
+# Errors from copy_file_range/sendfile meaning "not supported for these
+# files", after which the next, slower copy method is tried.
+COPY_FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+    errno.EPERM,
+}
+
+# Results of 'run' requests with a "cache" TTL, least recently used first.
+# Entries are evicted past RUN_CACHE_MAX_ENTRIES or RUN_CACHE_MAX_BYTES of
+# command output. The cache only lives as long as this process: the
+# extension starts a new process for every message, so it is only shared
+# between requests in daemon mode (TRIDACTYL_NATIVE_DAEMON=1), or within
+# one long-lived connection.
+RUN_CACHE = OrderedDict()
+RUN_CACHE_LOCK = threading.Lock()
+RUN_CACHE_BYTES = [0]
+RUN_CACHE_DEFAULT_TTL = 60
+RUN_CACHE_MAX_ENTRIES = 256
+RUN_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Cancellation events of the running background jobs, keyed by job id, so
+# that a 'cancel' can come from any connection (the extension opens a new
+# one per message). PENDING_JOBS counts the running jobs of each
+# connection, keyed by its send function.
+JOBS = {}
+PENDING_JOBS = {}
+JOBS_CHANGED = threading.Condition()
+
+# Serializes writes to stdout; other streams get a lock of their own.
+STDOUT_LOCK = threading.Lock()
+
+# With TRIDACTYL_NATIVE_DAEMON=1 in the browser's environment, the
+# browser-launched process only relays messages to a shared per-user
+# daemon, starting it if needed. The daemon exits after DAEMON_IDLE_TIMEOUT
+# seconds without connections.
+DAEMON_ENABLED = os.environ.get("TRIDACTYL_NATIVE_DAEMON") == "1"
+DAEMON_IDLE_TIMEOUT = int(
+    os.environ.get("TRIDACTYL_NATIVE_DAEMON_IDLE") or 10 * 60
+)
+DAEMON_START_TIMEOUT = 5
+
+# Incoming messages larger than MAX_FRAME_SIZE bytes are skipped with an
+# error reply. Each connection buffers at most MAX_PENDING_REQUESTS
+# messages while its REQUEST_WORKERS threads handle them, and all
+# connections together at most MAX_PENDING_BYTES; past that, input is not
+# read until some are done. With more than one worker, replies may be
+# sent out of order.
+MAX_FRAME_SIZE = int(
+    os.environ.get("TRIDACTYL_NATIVE_MAX_FRAME") or 64 * 1024 * 1024
+)
+MAX_PENDING_BYTES = int(
+    os.environ.get("TRIDACTYL_NATIVE_MAX_PENDING_BYTES") or 128 * 1024 * 1024
+)
+MAX_PENDING_REQUESTS = int(
+    os.environ.get("TRIDACTYL_NATIVE_MAX_PENDING") or 64
+)
+REQUEST_WORKERS = int(os.environ.get("TRIDACTYL_NATIVE_WORKERS") or 1)
+
+# Bytes of messages read but not yet handled, across all connections.
+PENDING_BYTES = [0]
+PENDING_BYTES_CHANGED = threading.Condition()
+
+# 'grep' scans up to GREP_WORKERS files at once, memory-maps files of at
+# least GREP_MMAP_THRESHOLD bytes and sends matches in batches of
+# GREP_CHUNK_SIZE. Matching lines are cut to GREP_MAX_LINE characters.
+# No reply carries more than GREP_MAX_REPLY_BYTES of matches, well under
+# Firefox's 1 MB limit on messages from the native app.
+GREP_WORKERS = min(8, (os.cpu_count() or 1) + 4)
+GREP_MMAP_THRESHOLD = 1024 * 1024
+GREP_CHUNK_SIZE = 100
+GREP_MAX_LINE = 1000
+GREP_MAX_REPLY_BYTES = 512 * 1024
+
 
 class NoConnectionError(Exception):
     """ Exception thrown when stdin cannot be read """
 
 
+class FrameTooLarge(ValueError):
+    """ Exception thrown when a message is larger than MAX_FRAME_SIZE """
+
+    def __init__(self, size):
+        super().__init__("Message too large")
+        self.size = size
+
+
+class CopyCancelled(Exception):
+    """ Exception thrown when a 'copy' or 'move' job is cancelled """
+
+
 def is_command_on_path(command):
     """ Returns 'True' if the if the specified command is found on
         user's $PATH.
@@ -43,21 +156,46 @@ def getenv(variable, default):
     return os.environ.get(variable) or default
 
 
-def getMessage():
-    """Read a message from stdin and decode it.
+def readFrame(stream=None, reserve=None):
+    """Read the raw content of a message from stdin (or the given stream).
 
     "Each message is serialized using JSON, UTF-8 encoded and is preceded with
     a 32-bit value containing the message length in native byte order."
 
     https://developer.mozilla.org/en-US/Add-ons/WebExtensions/Native_messaging#App_side
 
+    Messages over MAX_FRAME_SIZE are skipped and raise FrameTooLarge.
+    Otherwise reserve(length), if given, is called before the content is
+    read and may block to hold off reading.
     """
-    rawLength = sys.stdin.buffer.read(4)
-    if len(rawLength) == 0:
-        sys.exit(0)
+    if stream is None:
+        stream = sys.stdin.buffer
+    rawLength = stream.read(4)
+    if len(rawLength) < 4:
+        raise NoConnectionError()
     messageLength = struct.unpack("@I", rawLength)[0]
-    message = sys.stdin.buffer.read(messageLength).decode("utf-8")
-    return json.loads(message)
+
+    if messageLength > MAX_FRAME_SIZE:
+        # Discard the content in small chunks to find the next message
+        remaining = messageLength
+        while remaining:
+            chunk = stream.read(min(remaining, 64 * 1024))
+            if not chunk:
+                raise NoConnectionError()
+            remaining -= len(chunk)
+        raise FrameTooLarge(messageLength)
+
+    if reserve is not None:
+        reserve(messageLength)
+    message = stream.read(messageLength)
+    if len(message) < messageLength:
+        raise NoConnectionError()
+    return message
+
+
+def getMessage(stream=None):
+    """ Read a message from stdin (or the given stream) and decode it. """
+    return json.loads(readFrame(stream).decode("utf-8"))
 
 
 # Encode a message for transmission,
@@ -70,16 +208,24 @@ def encodeMessage(messageContent):
 
 
 # Send an encoded message to stdout
-def sendMessage(encodedMessage):
-    """ Send an encoded message to stdout."""
-    sys.stdout.buffer.write(encodedMessage["length"])
-    sys.stdout.buffer.write(encodedMessage["content"])
-    try:
-        sys.stdout.buffer.write(encodedMessage["code"])
-    except KeyError:
-        pass
+def sendMessage(encodedMessage, stream=None, lock=None):
+    """ Send an encoded message to stdout (or the given stream, holding
+    lock, if any, while writing)."""
+    if stream is None:
+        stream = sys.stdout.buffer
+        lock = STDOUT_LOCK
+    if lock is None:
+        lock = contextlib.nullcontext()
+    # Background jobs reply from their own threads
+    with lock:
+        stream.write(encodedMessage["length"])
+        stream.write(encodedMessage["content"])
+        try:
+            stream.write(encodedMessage["code"])
+        except KeyError:
+            pass
 
-    sys.stdout.buffer.flush()
+        stream.flush()
 
 
 def findUserConfigFile():
@@ -139,6 +285,567 @@ def sanitizeFilename(fn):
     return fn
 
 
+def is_private_dir(path):
+    """ Returns 'True' if path is a real directory that only the current
+        user can access.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    if not hasattr(os, "getuid"):
+        # No POSIX ownership to check (Windows); the user profile's temp
+        # directory is already private.
+        return True
+    return st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+
+
+def getTempDir():
+    """ Return the per-user scratch directory for 'temp' files, creating it
+    if necessary.
+
+    A tmpfs-backed location ($XDG_RUNTIME_DIR, then /dev/shm) is preferred
+    over the system temp directory when available. Returns None if no
+    private directory could be made; the shared temp directory itself is
+    never used, as other users can plant files and symlinks there.
+    """
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    candidates = []
+    runtime_dir = getenv("XDG_RUNTIME_DIR", None)
+    if runtime_dir:
+        candidates.append(os.path.join(runtime_dir, "tridactyl"))
+    if os.path.isdir("/dev/shm"):
+        candidates.append(
+            os.path.join("/dev/shm", "tridactyl-{}".format(user))
+        )
+    candidates.append(
+        os.path.join(tempfile.gettempdir(), "tridactyl-{}".format(user))
+    )
+
+    for path in candidates:
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+        except OSError:
+            continue
+        # Refuse directories another user created (or symlinked) for us.
+        if is_private_dir(path):
+            return path
+
+    return None
+
+
+def is_temp_name(name):
+    """ Returns 'True' if name is that of a file made by 'temp'. """
+    return name.startswith("tmp_") and name.endswith(".txt")
+
+
+def gcTempDir(temp_dir, keep=None):
+    """ Delete stale 'temp' files from temp_dir.
+
+    Files older than TEMP_MAX_AGE are removed, then the oldest remaining
+    files are removed until the directory is under TEMP_MAX_BYTES. The
+    path given in keep is never removed.
+    """
+    now = time.time()
+    entries = []
+    try:
+        names = os.listdir(temp_dir)
+    except OSError:
+        return
+
+    for name in names:
+        if not is_temp_name(name):
+            continue
+        path = os.path.join(temp_dir, name)
+        if path == keep:
+            continue
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    entries.sort()
+    total = sum(size for (_, size, _) in entries)
+    for (mtime, size, path) in entries:
+        if now - mtime <= TEMP_MAX_AGE and total <= TEMP_MAX_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def copyFile(src, dst, progress=None, cancelled=None):
+    """ Copy the contents of the file src to dst.
+
+    The copy is done by the kernel with copy_file_range or sendfile where
+    possible, falling back to a chunked read/write loop. progress(copied,
+    total) is called after every chunk, and CopyCancelled is raised as soon
+    as the threading.Event cancelled is set.
+    """
+    total = os.path.getsize(src)
+    copied = 0
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+
+        def readwrite():
+            chunk = fsrc.read(COPY_CHUNK_SIZE)
+            fdst.write(chunk)
+            return len(chunk)
+
+        methods = []
+        if hasattr(os, "copy_file_range"):
+            methods.append(
+                lambda: os.copy_file_range(infd, outfd, COPY_CHUNK_SIZE)
+            )
+        if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+            methods.append(
+                lambda: os.sendfile(outfd, infd, None, COPY_CHUNK_SIZE)
+            )
+        methods.append(readwrite)
+
+        for method in methods:
+            try:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise CopyCancelled()
+                    n = method()
+                    if not n:
+                        break
+                    copied += n
+                    if progress is not None:
+                        progress(copied, total)
+                break
+            except OSError as e:
+                # Only switch methods before anything has been written
+                if copied or e.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+
+    shutil.copystat(src, dst)
+    return copied
+
+
+def overwritePolicy(message):
+    """ Return the overwrite policy of a 'copy' or 'move' request, or None
+    if it isn't one of "never", "always" or "newer".
+    """
+    overwrite = message.get("overwrite", "never")
+    if overwrite is True:
+        return "always"
+    if overwrite is False or overwrite is None:
+        return "never"
+    if overwrite in ("never", "always", "newer"):
+        return overwrite
+    return None
+
+
+def transferFile(message, progress=None, cancelled=None):
+    """ Copy or move message["from"] to message["to"].
+
+    message["overwrite"] is the policy for an existing destination file:
+    "never" (the default), "always" or "newer" (only if the source is more
+    recent). For compatibility, true and false mean "always" and "never".
+    Existing directories (and other non-files) are never overwritten, and
+    a directory never overwrites anything.
+
+    Returns a reply code: 0 on success, 1 if the destination exists and
+    was not overwritten, 2 on other errors and 3 if cancelled. If
+    message["cleanup"] is set, the source is removed when a move fails
+    (but not when it is cancelled).
+    """
+    src = os.path.expanduser(message["from"])
+    dest = os.path.expanduser(message["to"])
+    is_move = message["cmd"] == "move"
+
+    overwrite = overwritePolicy(message)
+
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src.rstrip(os.sep)))
+
+    code = 0
+    if os.path.lexists(dest) and (
+        # Only plain files are ever replaced, and never by a directory
+        os.path.isdir(src)
+        or not os.path.isfile(dest)
+        or overwrite == "never"
+        or (
+            overwrite == "newer"
+            and os.path.getmtime(src) <= os.path.getmtime(dest)
+        )
+    ):
+        code = 1
+    elif os.path.isdir(src):
+        # Directory trees are not reported on, but can still be cancelled
+        # while their files are copied (across filesystems, for a move)
+        def copy(s, d):
+            copyFile(s, d, cancelled=cancelled)
+
+        try:
+            if is_move:
+                shutil.move(src, dest, copy_function=copy)
+            else:
+                shutil.copytree(src, dest, copy_function=copy)
+        except CopyCancelled:
+            code = 3
+            # The source is only removed after a complete copy, so the
+            # partial tree can go
+            shutil.rmtree(dest, ignore_errors=True)
+        except Exception:
+            code = 2
+    else:
+        try:
+            if is_move:
+                os.replace(src, dest)
+            else:
+                raise OSError(errno.EXDEV, "Copy requested")
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                code = 2
+            else:
+                # Copy to a partial file first so that an existing
+                # destination is only replaced by a complete copy.
+                part = dest + ".part"
+                try:
+                    copyFile(src, part, progress, cancelled)
+                    os.replace(part, dest)
+                    if is_move:
+                        os.unlink(src)
+                except CopyCancelled:
+                    code = 3
+                except Exception:
+                    code = 2
+                if code != 0 and os.path.isfile(part):
+                    os.unlink(part)
+
+    if is_move and code not in (0, 3) and message.get("cleanup"):
+        try:
+            os.unlink(src)
+        except OSError:
+            pass
+
+    return code
+
+
+def transferJob(message, send):
+    """ Run a 'copy' or 'move' request that has an id in the background,
+    so that it can be cancelled and other requests are not blocked.
+    """
+    job_id = message["id"]
+    cancelled = threading.Event()
+    with JOBS_CHANGED:
+        JOBS[job_id] = cancelled
+        PENDING_JOBS[send] = PENDING_JOBS.get(send, 0) + 1
+
+    last = [0.0]
+
+    def progress(copied, total):
+        now = time.monotonic()
+        if now - last[0] < PROGRESS_INTERVAL and copied != total:
+            return
+        last[0] = now
+        send(
+            {
+                "cmd": message["cmd"],
+                "id": job_id,
+                "progress": {"copied": copied, "total": total},
+            }
+        )
+
+    def run():
+        try:
+            code = transferFile(
+                message,
+                progress if message.get("progress") else None,
+                cancelled,
+            )
+        except Exception as e:
+            eprint("{} failed: {}".format(message["cmd"], e))
+            code = 2
+        try:
+            send({"cmd": message["cmd"], "id": job_id, "code": code})
+        finally:
+            with JOBS_CHANGED:
+                if JOBS.get(job_id) is cancelled:
+                    del JOBS[job_id]
+                PENDING_JOBS[send] -= 1
+                if not PENDING_JOBS[send]:
+                    del PENDING_JOBS[send]
+                JOBS_CHANGED.notify_all()
+
+    threading.Thread(target=run).start()
+
+
+def grepFile(path, regex, emit, stop):
+    """ Search the file at path for regex, calling emit(match) with the
+    first match of every matching line until emit returns False or the
+    threading.Event stop is set. Binary files and anything that isn't a
+    regular file are skipped.
+    """
+    # Opening without blocking, then checking the type, means a FIFO or
+    # device swapped in after the directory walk can't hang the search
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_NONBLOCK", 0))
+    with open(fd, "rb") as file:
+        st = os.fstat(file.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return
+        size = st.st_size
+        if size == 0:
+            return
+        if size >= GREP_MMAP_THRESHOLD:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = file.read()
+
+    try:
+        if data.find(b"\0", 0, 8192) != -1:
+            return
+        line = 1
+        counted = 0
+        pos = 0
+        while not stop.is_set():
+            found = regex.search(data, pos)
+            if found is None:
+                break
+            start = found.start()
+            line += data[counted:start].count(b"\n")
+            counted = start
+            line_start = data.rfind(b"\n", 0, start) + 1
+            line_end = data.find(b"\n", start)
+            if line_end == -1:
+                line_end = len(data)
+            text = data[line_start:line_end].decode("utf-8", "replace")
+            column = len(
+                data[line_start:start].decode("utf-8", "replace")
+            ) + 1
+            if not emit(
+                {
+                    "file": path,
+                    "line": line,
+                    "column": column,
+                    "text": text.rstrip("\r")[:GREP_MAX_LINE],
+                }
+            ):
+                break
+            # One result per line
+            pos = line_end + 1
+            if pos > len(data):
+                break
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def is_regular_file(path):
+    """ Returns 'True' if path is (or links to) a regular file. """
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def iterGrepFiles(paths, stop):
+    """ Yield the regular files in paths, walking directories recursively
+    as it goes, until the threading.Event stop is set.
+    """
+    for path in paths:
+        path = os.path.expandvars(os.path.expanduser(path))
+        if os.path.isdir(path):
+            for (root, _, names) in os.walk(path):
+                for name in names:
+                    if stop.is_set():
+                        return
+                    filepath = os.path.join(root, name)
+                    if is_regular_file(filepath):
+                        yield filepath
+        elif is_regular_file(path):
+            yield path
+
+
+def grep(message, send):
+    """ Search message["paths"] (files or directories, searched
+    recursively) for message["pattern"], a literal string unless
+    message["regex"] is set.
+
+    Matches are sent in batches as they are found if message["stream"] is
+    set, otherwise they are returned in the reply, which stops the search
+    once it holds GREP_MAX_REPLY_BYTES. Every batch and the reply carry
+    message["id"]. The search stops
+    after message["max_count"] matches, if given; the reply is marked
+    "truncated" if more matches were found.
+    """
+    reply = {"cmd": "grep", "id": message.get("id")}
+    pattern = message["pattern"]
+    if not message.get("regex"):
+        pattern = re.escape(pattern)
+    flags = re.MULTILINE
+    if message.get("ignore_case"):
+        flags |= re.IGNORECASE
+    try:
+        regex = re.compile(pattern.encode("utf-8"), flags)
+    except re.error as e:
+        reply["code"] = 2
+        reply["error"] = "Invalid pattern: {}".format(e)
+        return reply
+
+    paths = message.get("paths") or [message["path"]]
+    if not isinstance(paths, list) or not all(
+        isinstance(path, str) for path in paths
+    ):
+        reply["code"] = 2
+        reply["error"] = "'paths' must be a list of strings"
+        return reply
+
+    max_count = message.get("max_count")
+    stream = message.get("stream")
+    results = queue.Queue()
+    stop = threading.Event()
+    lock = threading.Lock()
+    count = [0]
+    truncated = [False]
+
+    def emit(match):
+        with lock:
+            if stop.is_set():
+                return False
+            if max_count is not None and count[0] >= max_count:
+                # One match too many: drop it and stop every worker
+                truncated[0] = True
+                stop.set()
+                return False
+            count[0] += 1
+        results.put(match)
+        return True
+
+    # Keeps the walk only a little ahead of the search
+    slots = threading.BoundedSemaphore(GREP_WORKERS * 4)
+
+    def search(path):
+        try:
+            if not stop.is_set():
+                grepFile(path, regex, emit, stop)
+        except (OSError, ValueError) as e:
+            # Unreadable files are skipped, like grep -s
+            if DEBUG:
+                eprint("grep: {}: {}".format(path, e))
+        finally:
+            slots.release()
+            results.put(None)
+
+    def walk(executor):
+        # Files are searched as they are found; the number of files is
+        # sent last, so the loop below knows when everything is done
+        submitted = 0
+        try:
+            for path in iterGrepFiles(paths, stop):
+                slots.acquire()
+                executor.submit(search, path)
+                submitted += 1
+        finally:
+            results.put(submitted)
+
+    matches = []
+    size = 0
+    delivered = 0
+    with ThreadPoolExecutor(GREP_WORKERS) as executor:
+        walker = threading.Thread(target=walk, args=(executor,))
+        walker.start()
+        total = None
+        finished = 0
+        while total is None or finished < total:
+            match = results.get()
+            if match is None:
+                finished += 1
+                continue
+            if isinstance(match, int):
+                total = match
+                continue
+            match_size = len(json.dumps(match)) + 2
+            if size + match_size > GREP_MAX_REPLY_BYTES:
+                if not stream:
+                    # The reply is full: drop the rest
+                    truncated[0] = True
+                    stop.set()
+                    continue
+                send({"cmd": "grep", "id": reply["id"], "matches": matches})
+                matches = []
+                size = 0
+            matches.append(match)
+            size += match_size
+            delivered += 1
+            if stream and len(matches) >= GREP_CHUNK_SIZE:
+                send({"cmd": "grep", "id": reply["id"], "matches": matches})
+                matches = []
+                size = 0
+        walker.join()
+
+    reply["matches"] = matches
+    reply["count"] = delivered
+    reply["truncated"] = truncated[0]
+    reply["code"] = 0 if delivered else 1
+    return reply
+
+
+def runCacheGet(key):
+    """ Return the cached (content, code) of a 'run' request, or None if it
+    is not cached or has expired.
+    """
+    with RUN_CACHE_LOCK:
+        entry = RUN_CACHE.get(key)
+        if entry is None:
+            return None
+        (expires, size, result) = entry
+        if time.monotonic() >= expires:
+            del RUN_CACHE[key]
+            RUN_CACHE_BYTES[0] -= size
+            return None
+        RUN_CACHE.move_to_end(key)
+        return result
+
+
+def runCachePut(key, result, ttl):
+    """ Cache the (content, code) of a 'run' request for ttl seconds,
+    evicting the least recently used entries to stay within bounds.
+    """
+    size = len(key[0]) + len(key[1]) + len(result[0])
+    if size > RUN_CACHE_MAX_BYTES:
+        return
+    with RUN_CACHE_LOCK:
+        old = RUN_CACHE.pop(key, None)
+        if old is not None:
+            RUN_CACHE_BYTES[0] -= old[1]
+        RUN_CACHE[key] = (time.monotonic() + ttl, size, result)
+        RUN_CACHE_BYTES[0] += size
+        while (
+            len(RUN_CACHE) > RUN_CACHE_MAX_ENTRIES
+            or RUN_CACHE_BYTES[0] > RUN_CACHE_MAX_BYTES
+        ):
+            (_, (_, evicted, _)) = RUN_CACHE.popitem(last=False)
+            RUN_CACHE_BYTES[0] -= evicted
+
+
+def runCacheInvalidate(command=None):
+    """ Drop the cached results of command, or of every command if None.
+    Returns the number of entries dropped.
+    """
+    with RUN_CACHE_LOCK:
+        keys = [
+            key for key in RUN_CACHE if command is None or key[0] == command
+        ]
+        for key in keys:
+            RUN_CACHE_BYTES[0] -= RUN_CACHE.pop(key)[1]
+    return len(keys)
+
+
 def is_valid_firefox_profile(profile_dir):
     is_valid = False
     validity_indicator = "times.json"
@@ -391,8 +1098,14 @@ def write_log(msg):
     open(debug_log_path, "a+").write(msg)
 
 
-def handleMessage(message):
-    """ Generate reply from incoming message. """
+def handleMessage(message, send=None):
+    """ Generate reply from incoming message.
+
+    send(reply) delivers extra or delayed replies on the same connection,
+    stdout by default. Returns None when the reply will be sent later.
+    """
+    if send is None:
+        send = lambda reply: sendMessage(encodeMessage(reply))
     cmd = message["cmd"]
     reply = {"cmd": cmd}
 
@@ -421,14 +1134,49 @@ def handleMessage(message):
 
     elif cmd == "run":
         commands = message["command"]
-        stdin = message.get("content", "").encode("utf-8")
+        stdin = message.get("content", "")
+
+        # Opt-in memoization for idempotent commands: "cache" is a TTL in
+        # seconds, or true for RUN_CACHE_DEFAULT_TTL.
+        ttl = message.get("cache")
+        if ttl is True:
+            ttl = RUN_CACHE_DEFAULT_TTL
+        elif ttl is False:
+            ttl = None
+        elif ttl is not None:
+            try:
+                ttl = float(ttl)
+            except (TypeError, ValueError):
+                ttl = float("nan")
+            if not 0 < ttl < float("inf"):
+                return {
+                    "cmd": "error",
+                    "error": "Invalid cache TTL: {!r}".format(
+                        message["cache"]
+                    ),
+                    "code": -1,
+                }
+        key = (commands, stdin)
+        cached = runCacheGet(key) if ttl else None
+
+        if cached is not None:
+            (reply["content"], reply["code"]) = cached
+            reply["cached"] = True
+        else:
+            p = subprocess.Popen(commands, shell=True,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
 
-        p = subprocess.Popen(commands, shell=True,
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE)
+            reply["content"] = p.communicate(stdin.encode("utf-8"))[0].decode(
+                "utf-8"
+            )
+            reply["code"] = p.returncode
+            if ttl:
+                runCachePut(key, (reply["content"], reply["code"]), ttl)
 
-        reply["content"] = p.communicate(stdin)[0].decode("utf-8")
-        reply["code"] = p.returncode
+    elif cmd == "run_invalidate":
+        reply["content"] = runCacheInvalidate(message.get("command"))
+        reply["code"] = 0
 
     elif cmd == "eval":
         output = eval(message["command"])
@@ -456,16 +1204,32 @@ def handleMessage(message):
         reply["content"] = ""
         reply["code"] = 0
 
-    elif cmd == "move":
-        dest = os.path.expanduser(message["to"])
-        if (os.path.isfile(dest)):
+    elif cmd in ("copy", "move"):
+        if overwritePolicy(message) is None:
+            return {
+                "cmd": "error",
+                "error": "Invalid overwrite policy: {!r}".format(
+                    message["overwrite"]
+                ),
+                "code": -1,
+            }
+        if "id" in message:
+            # Replies (and progress frames) are sent by the job itself
+            transferJob(message, send)
+            return None
+        try:
+            reply["code"] = transferFile(message)
+        except Exception:
+            reply["code"] = 2
+
+    elif cmd == "cancel":
+        with JOBS_CHANGED:
+            cancelled = JOBS.get(message["id"])
+        if cancelled is None:
             reply["code"] = 1
         else:
-            try:
-                shutil.move(os.path.expanduser(message["from"]), dest)
-                reply["code"] = 0
-            except Exception:
-                reply["code"] = 2
+            cancelled.set()
+            reply["code"] = 0
 
     elif cmd == "write":
         with open(message["file"], "w", encoding="utf-8") as file:
@@ -488,12 +1252,46 @@ def handleMessage(message):
         if prefix is None:
             prefix = ""
         prefix = "tmp_{}_".format(sanitizeFilename(prefix))
-
-        (handle, filepath) = tempfile.mkstemp(prefix=prefix, suffix=".txt")
-        with os.fdopen(handle, "w", encoding="utf-8") as file:
-            file.write(message["content"])
+        temp_dir = getTempDir()
+
+        if temp_dir is None:
+            # No private directory: plain mkstemp files, no reuse or GC
+            (handle, filepath) = tempfile.mkstemp(prefix=prefix, suffix=".txt")
+            with os.fdopen(handle, "w", encoding="utf-8") as file:
+                file.write(message["content"])
+        elif message.get("reuse"):
+            # One file per prefix, so repeated edits of the same field
+            # overwrite it instead of piling up new files.
+            filepath = os.path.join(temp_dir, prefix + "reuse.txt")
+            gcTempDir(temp_dir, keep=filepath)
+            with open(filepath, "w", encoding="utf-8") as file:
+                file.write(message["content"])
+        else:
+            gcTempDir(temp_dir)
+            (handle, filepath) = tempfile.mkstemp(
+                prefix=prefix, suffix=".txt", dir=temp_dir
+            )
+            with os.fdopen(handle, "w", encoding="utf-8") as file:
+                file.write(message["content"])
         reply["content"] = filepath
 
+    elif cmd == "release":
+        # Only 'temp' files inside the scratch directory may be released.
+        path = os.path.realpath(os.path.expanduser(message["file"]))
+        temp_dir = getTempDir()
+        if (
+            temp_dir is None
+            or os.path.dirname(path) != os.path.realpath(temp_dir)
+            or not is_temp_name(os.path.basename(path))
+        ):
+            reply["code"] = 1
+        else:
+            try:
+                os.unlink(path)
+                reply["code"] = 0
+            except OSError:
+                reply["code"] = 2  # Missing, a directory, etc.
+
     elif cmd == "env":
         reply["content"] = getenv(message["var"], "")
 
@@ -510,6 +1308,9 @@ def handleMessage(message):
                 path = "./"
         reply["files"] = os.listdir(path)
 
+    elif cmd == "grep":
+        reply = grep(message, send)
+
     else:
         reply = {"cmd": "error", "error": "Unhandled message"}
         eprint("Unhandled message: {}".format(message))
@@ -517,7 +1318,328 @@ def handleMessage(message):
     return reply
 
 
-while True:
-    message = getMessage()
-    reply = handleMessage(message)
-    sendMessage(encodeMessage(reply))
+def serve(instream=None, outstream=None):
+    """ Reply to messages from instream (default stdin) on outstream
+    (default stdout) until instream is closed.
+    """
+
+    # A client that stops reading only blocks its own replies
+    lock = STDOUT_LOCK if outstream is None else threading.Lock()
+
+    def send(reply):
+        sendMessage(encodeMessage(reply), outstream, lock)
+
+    requests = queue.Queue(MAX_PENDING_REQUESTS)
+    # Budget reserved for the frame being read, if any
+    reserved = [0]
+
+    def reserve(size):
+        # A message larger than the whole budget still gets in on its own
+        with PENDING_BYTES_CHANGED:
+            PENDING_BYTES_CHANGED.wait_for(
+                lambda: PENDING_BYTES[0] == 0
+                or PENDING_BYTES[0] + size <= MAX_PENDING_BYTES
+            )
+            PENDING_BYTES[0] += size
+        reserved[0] = size
+
+    def release(size):
+        with PENDING_BYTES_CHANGED:
+            PENDING_BYTES[0] -= size
+            PENDING_BYTES_CHANGED.notify_all()
+
+    def work():
+        while True:
+            item = requests.get()
+            if item is None:
+                return
+            (message, size) = item
+            try:
+                reply = handleMessage(message, send)
+            except Exception as e:
+                eprint("Error handling message {}: {}".format(message, e))
+                reply = {"cmd": "error", "error": str(e)}
+            finally:
+                # Released before replying, so that a client which stops
+                # reading can't hold on to the shared budget
+                release(size)
+            if reply is not None:
+                try:
+                    send(reply)
+                except Exception:
+                    pass
+
+    workers = [
+        threading.Thread(target=work) for _ in range(max(REQUEST_WORKERS, 1))
+    ]
+    for worker in workers:
+        worker.start()
+
+    while True:
+        try:
+            frame = readFrame(instream, reserve)
+        except NoConnectionError:
+            # Closed halfway through a frame
+            if reserved[0]:
+                release(reserved[0])
+            break
+        except FrameTooLarge as e:
+            send(
+                {
+                    "cmd": "error",
+                    "error": "Message too large",
+                    "code": -1,
+                    "size": e.size,
+                    "max": MAX_FRAME_SIZE,
+                }
+            )
+            continue
+        try:
+            message = json.loads(frame.decode("utf-8"))
+        except ValueError:
+            reserved[0] = 0
+            release(len(frame))
+            send({"cmd": "error", "error": "Invalid message", "code": -1})
+            continue
+        reserved[0] = 0
+        requests.put((message, len(frame)))
+
+    for worker in workers:
+        requests.put(None)
+    for worker in workers:
+        worker.join()
+
+    # Let background jobs deliver their final replies before hanging up
+    with JOBS_CHANGED:
+        JOBS_CHANGED.wait_for(lambda: send not in PENDING_JOBS)
+
+
+def parseVersion(version):
+    """ Turn a version string like "0.1.11" into a comparable tuple, or None
+    if it isn't one.
+    """
+    if not isinstance(version, str):
+        return None
+    parts = re.findall(r"\d+", version)
+    if not parts:
+        return None
+    return tuple(int(part) for part in parts)
+
+
+def getSocketPath():
+    """ Return the path of the daemon's socket, which lives in the private
+    per-user scratch directory, or None if there is no such directory.
+    """
+    temp_dir = getTempDir()
+    if temp_dir is None:
+        return None
+    return os.path.join(temp_dir, "native.sock")
+
+
+def unlinkSocket(path, inode):
+    """ Remove the socket at path, unless another daemon has replaced it. """
+    try:
+        if os.stat(path).st_ino == inode:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+def runDaemon():
+    """ Serve every connection to the per-user socket until no connection
+    has been open for DAEMON_IDLE_TIMEOUT seconds.
+
+    Each connection starts with a {"cmd": "hello", "version": ...} message.
+    Clients of another version get an error reply. A newer client also
+    makes the daemon stop listening, so that it can start a daemon of its
+    own version; older clients are expected to run standalone.
+    """
+    path = getSocketPath()
+    if path is None:
+        eprint("No private directory for the daemon's socket")
+        return
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+    except OSError:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            # Another daemon is already listening
+            probe.close()
+            server.close()
+            return
+        except OSError:
+            probe.close()
+        # Stale socket left behind by a daemon that died
+        os.unlink(path)
+        server.bind(path)
+    os.chmod(path, 0o600)
+    inode = os.stat(path).st_ino
+    server.listen()
+    server.settimeout(1)
+
+    stopping = threading.Event()
+    active = [0]
+    last_active = [time.monotonic()]
+    lock = threading.Lock()
+
+    def handleConnection(conn):
+        instream = conn.makefile("rb")
+        outstream = conn.makefile("wb")
+        try:
+            hello = getMessage(instream)
+            if not isinstance(hello, dict) or hello.get("cmd") != "hello":
+                sendMessage(
+                    encodeMessage(
+                        {"cmd": "error", "error": "Expected hello"}
+                    ),
+                    outstream,
+                )
+                return
+            if hello.get("version") != VERSION:
+                theirs = parseVersion(hello.get("version"))
+                if theirs is not None and theirs > parseVersion(VERSION):
+                    stopping.set()
+                    unlinkSocket(path, inode)
+                sendMessage(
+                    encodeMessage(
+                        {
+                            "cmd": "error",
+                            "error": "Version mismatch",
+                            "version": VERSION,
+                        }
+                    ),
+                    outstream,
+                )
+                return
+            sendMessage(
+                encodeMessage({"cmd": "hello", "version": VERSION}), outstream
+            )
+            serve(instream, outstream)
+        except (NoConnectionError, OSError, ValueError):
+            pass
+        finally:
+            instream.close()
+            outstream.close()
+            conn.close()
+            with lock:
+                active[0] -= 1
+                last_active[0] = time.monotonic()
+
+    while not stopping.is_set():
+        try:
+            (conn, _) = server.accept()
+        except socket.timeout:
+            with lock:
+                if (
+                    active[0] == 0
+                    and time.monotonic() - last_active[0]
+                    > DAEMON_IDLE_TIMEOUT
+                ):
+                    break
+            continue
+        with lock:
+            active[0] += 1
+        threading.Thread(target=handleConnection, args=(conn,)).start()
+
+    server.close()
+    unlinkSocket(path, inode)
+
+
+def connectDaemon(path):
+    """ Connect to the daemon listening on path and check that it runs the
+    same version. Returns the connected socket (or None) and the daemon's
+    version (or None if it couldn't be reached).
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        hello = encodeMessage({"cmd": "hello", "version": VERSION})
+        conn.sendall(hello["length"] + hello["content"])
+        with conn.makefile("rb") as instream:
+            reply = getMessage(instream)
+    except (NoConnectionError, OSError, ValueError):
+        conn.close()
+        return (None, None)
+    if not isinstance(reply, dict):
+        conn.close()
+        return (None, None)
+    if reply.get("version") != VERSION or reply.get("cmd") == "error":
+        conn.close()
+        return (None, reply.get("version"))
+    return (conn, VERSION)
+
+
+def startDaemon():
+    """ Start a detached daemon process. """
+    if getattr(sys, "frozen", False):
+        # Bundled executable (e.g. PyInstaller)
+        args = [sys.executable, "--daemon"]
+    else:
+        args = [sys.executable, os.path.abspath(__file__), "--daemon"]
+    subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def relay():
+    """ Forward messages between stdin/stdout and the daemon, starting it
+    if it isn't running. Returns False if no daemon could be reached.
+    """
+    path = getSocketPath()
+    if path is None:
+        return False
+    (conn, version) = connectDaemon(path)
+    theirs = parseVersion(version)
+    if conn is None and theirs is not None and theirs >= parseVersion(VERSION):
+        # A newer daemon keeps running for its own clients
+        eprint("The native daemon is newer ({}), running standalone".format(
+            version
+        ))
+        return False
+    if conn is None:
+        startDaemon()
+        deadline = time.monotonic() + DAEMON_START_TIMEOUT
+        while conn is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+            (conn, _) = connectDaemon(path)
+        if conn is None:
+            eprint("Could not reach the native daemon, running standalone")
+            return False
+
+    # Both sides use the same framing, so bytes are passed through as is
+    def forwardStdin():
+        try:
+            while True:
+                data = os.read(sys.stdin.fileno(), 65536)
+                if not data:
+                    break
+                conn.sendall(data)
+        except OSError:
+            pass
+        finally:
+            try:
+                conn.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    threading.Thread(target=forwardStdin, daemon=True).start()
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+    conn.close()
+    return True
+
+
+if "--daemon" in sys.argv[1:]:
+    runDaemon()
+elif not (DAEMON_ENABLED and hasattr(socket, "AF_UNIX") and relay()):
+    serve()